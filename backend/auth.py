@@ -2,9 +2,26 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from googleapiclient.discovery import build
+from cachetools import TTLCache
+import hashlib
+import httpx
+import logging
 import os
+import threading
+import time
 from typing import Optional
 
+log = logging.getLogger("bytechat.auth")
+
+# Gmail allows at most 100 calls per batch request and throttles large batches
+GMAIL_BATCH_SIZE = 50
+# Seconds to wait before each retry of batch entries Gmail rejected as transient
+GMAIL_RETRY_DELAYS = (1, 2, 4)
+GMAIL_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenVerificationError(Exception):
+    """Google could not be reached to verify an access token"""
+
 class GmailAuth:
     def __init__(self, client_id: str, client_secret: str, redirect_uri: str = None):
         self.client_id = client_id
@@ -16,20 +33,39 @@ class GmailAuth:
             'https://www.googleapis.com/auth/userinfo.profile'
         ]
 
+        # OAuth client config shared by every Flow (Flows themselves are single-use)
+        self._client_config = {
+            "web": {
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "redirect_uris": [self.redirect_uri]
+            }
+        }
+
+        # Verified user info keyed by SHA-256 of the access token, so repeat
+        # requests skip the userinfo round-trip. Rejected tokens are cached
+        # briefly as well so a bad token can't hammer Google.
+        self._token_cache = TTLCache(maxsize=10_000, ttl=300)
+        self._invalid_token_cache = TTLCache(maxsize=10_000, ttl=10)
+        self._token_cache_lock = threading.Lock()
+
+        # Shared client so token checks reuse pooled keep-alive connections
+        # instead of paying a TLS handshake per request
+        self._http = httpx.AsyncClient(
+            http2=True,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+        )
+
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        await self._http.aclose()
+
     def get_authorization_url(self) -> str:
         """Generate the authorization URL for OAuth flow"""
-        flow = Flow.from_client_config(
-            {
-                "web": {
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "redirect_uris": [self.redirect_uri]
-                }
-            },
-            scopes=self.scopes
-        )
+        flow = Flow.from_client_config(self._client_config, scopes=self.scopes)
         flow.redirect_uri = self.redirect_uri
 
         authorization_url, _ = flow.authorization_url(
@@ -41,18 +77,7 @@ class GmailAuth:
 
     def exchange_code_for_tokens(self, code: str) -> dict:
         """Exchange authorization code for access tokens"""
-        flow = Flow.from_client_config(
-            {
-                "web": {
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret,
-                    "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-                    "token_uri": "https://oauth2.googleapis.com/token",
-                    "redirect_uris": [self.redirect_uri]
-                }
-            },
-            scopes=self.scopes
-        )
+        flow = Flow.from_client_config(self._client_config, scopes=self.scopes)
         flow.redirect_uri = self.redirect_uri
 
         flow.fetch_token(code=code)
@@ -65,48 +90,79 @@ class GmailAuth:
             'expires_in': credentials.expiry.timestamp() if credentials.expiry else None
         }
 
-    def verify_access_token(self, access_token: str) -> Optional[dict]:
-        """Verify access token and get user info"""
-        try:
-            import requests
+    async def verify_access_token(self, access_token: str) -> Optional[dict]:
+        """
+        Verify access token and get user info
+        Returns None for tokens Google rejects; raises TokenVerificationError if
+        Google couldn't be reached, which is not cached
+        """
+        cache_key = hashlib.sha256(access_token.encode()).hexdigest()
+        with self._token_cache_lock:
+            cached = self._token_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            if cache_key in self._invalid_token_cache:
+                return None
+
+        user_info = await self._fetch_user_info(access_token)
 
-            print(f"Verifying token (first 20 chars): {access_token[:20]}...")
-            print(f"Token length: {len(access_token)}")
+        with self._token_cache_lock:
+            if user_info:
+                self._token_cache[cache_key] = user_info
+            else:
+                self._invalid_token_cache[cache_key] = True
 
+        return user_info
+
+    async def _fetch_user_info(self, access_token: str) -> Optional[dict]:
+        """
+        Look up the user behind an access token via Google's userinfo endpoint
+        Returns None when Google rejects the token; raises TokenVerificationError
+        when Google can't give an answer (network error, timeout, 5xx)
+        """
+        log.debug("Verifying token prefix=%s len=%d", access_token[:20], len(access_token))
+
+        try:
             # Use Google's userinfo endpoint directly without credentials object
-            response = requests.get(
+            response = await self._http.get(
                 'https://www.googleapis.com/oauth2/v2/userinfo',
                 headers={'Authorization': f'Bearer {access_token}'}
             )
+        except httpx.HTTPError as e:
+            log.warning("Could not reach Google userinfo: %s", e)
+            raise TokenVerificationError(f"Could not reach Google to verify token: {e}") from e
 
-            print(f"Response status: {response.status_code}")
+        log.debug("Userinfo response status: %d", response.status_code)
 
-            if response.status_code != 200:
-                print(f"Token verification failed: {response.status_code} - {response.text}")
+        if response.status_code in (400, 401, 403):
+            log.info("Token verification failed: %d - %s", response.status_code, response.text)
 
-                # Try tokeninfo endpoint as alternative
-                print("Trying tokeninfo endpoint...")
-                token_info_response = requests.get(
-                    f'https://oauth2.googleapis.com/tokeninfo?access_token={access_token}'
-                )
-                print(f"Tokeninfo response: {token_info_response.status_code} - {token_info_response.text}")
+            # Ask tokeninfo why the token was rejected; diagnostic only
+            if log.isEnabledFor(logging.DEBUG):
+                try:
+                    token_info_response = await self._http.get(
+                        'https://oauth2.googleapis.com/tokeninfo',
+                        params={'access_token': access_token}
+                    )
+                    log.debug("Tokeninfo response: %d - %s", token_info_response.status_code, token_info_response.text)
+                except httpx.HTTPError as e:
+                    log.debug("Tokeninfo lookup failed: %s", e)
 
-                return None
+            return None
 
-            user_info = response.json()
-            print(f"Successfully verified token for user: {user_info.get('email')}")
+        if response.status_code != 200:
+            log.warning("Google userinfo returned %d - %s", response.status_code, response.text)
+            raise TokenVerificationError(f"Google userinfo returned {response.status_code}")
 
-            return {
-                'email': user_info.get('email'),
-                'name': user_info.get('name'),
-                'picture': user_info.get('picture'),
-                'verified_email': user_info.get('verified_email', False)
-            }
-        except Exception as e:
-            print(f"Token verification failed: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+        user_info = response.json()
+        log.debug("Successfully verified token for user: %s", user_info.get('email'))
+
+        return {
+            'email': user_info.get('email'),
+            'name': user_info.get('name'),
+            'picture': user_info.get('picture'),
+            'verified_email': user_info.get('verified_email', False)
+        }
 
     def get_gmail_service(self, access_token: str, refresh_token: str = None):
         """Get Gmail service instance"""
@@ -119,8 +175,72 @@ class GmailAuth:
 
         return build('gmail', 'v1', credentials=credentials)
 
+    def _get_message_metadata(self, service, message_id: str):
+        """Build a messages.get request that returns only the headers we display"""
+        return service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='metadata',
+            metadataHeaders=['Subject', 'From', 'Date']
+        )
+
+    def _batch_get_metadata(self, service, message_ids: list) -> dict:
+        """
+        Fetch message metadata for many ids via Gmail batch requests
+        Entries or whole batches rejected as transient (429/5xx) are retried after a
+        backoff; other failures and ids that keep failing are left out instead of
+        failing the whole fetch
+        """
+        fetched = {}
+        failed_ids = []
+
+        def is_transient(exception):
+            return getattr(getattr(exception, 'resp', None), 'status', None) in GMAIL_RETRY_STATUSES
+
+        def on_message(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif is_transient(exception):
+                failed_ids.append(request_id)
+            else:
+                log.info("Skipping Gmail message %s: %s", request_id, exception)
+
+        def run_batches(ids):
+            for start in range(0, len(ids), GMAIL_BATCH_SIZE):
+                chunk = ids[start:start + GMAIL_BATCH_SIZE]
+                batch = service.new_batch_http_request(callback=on_message)
+                for message_id in chunk:
+                    batch.add(self._get_message_metadata(service, message_id), request_id=message_id)
+                try:
+                    batch.execute()
+                except Exception as e:
+                    if not is_transient(e):
+                        log.warning("Skipping Gmail batch of %d messages: %s", len(chunk), e)
+                        continue
+                    log.warning("Gmail batch of %d messages failed: %s", len(chunk), e)
+                    failed_ids.extend(message_id for message_id in chunk if message_id not in fetched)
+
+        run_batches(message_ids)
+
+        for delay in GMAIL_RETRY_DELAYS:
+            if not failed_ids:
+                break
+            retry_ids = list(dict.fromkeys(failed_ids))
+            failed_ids.clear()
+            time.sleep(delay)
+            run_batches(retry_ids)
+
+        if failed_ids:
+            log.warning("Skipping %d Gmail messages that could not be fetched", len(set(failed_ids)))
+
+        return fetched
+
     def get_user_emails(self, access_token: str, refresh_token: str = None, max_results: int = 10):
-        """Fetch user's Gmail messages"""
+        """
+        Fetch user's Gmail messages
+        Blocking (network I/O plus retry backoff sleeps): call it from async code
+        via asyncio.to_thread, never directly on the event loop thread
+        """
         try:
             service = self.get_gmail_service(access_token, refresh_token)
 
@@ -132,27 +252,26 @@ class GmailAuth:
 
             messages = results.get('messages', [])
 
+            # Fetch messages in batch requests instead of one round-trip each
+            fetched = self._batch_get_metadata(service, [message['id'] for message in messages])
+
             email_data = []
             for message in messages:
-                msg = service.users().messages().get(
-                    userId='me',
-                    id=message['id']
-                ).execute()
+                msg = fetched.get(message['id'])
+                if msg is None:
+                    continue
 
-                headers = msg['payload'].get('headers', [])
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-                date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown Date')
+                headers = {h['name']: h['value'] for h in msg['payload'].get('headers', [])}
 
                 email_data.append({
                     'id': message['id'],
-                    'subject': subject,
-                    'sender': sender,
-                    'date': date,
+                    'subject': headers.get('Subject', 'No Subject'),
+                    'sender': headers.get('From', 'Unknown Sender'),
+                    'date': headers.get('Date', 'Unknown Date'),
                     'snippet': msg.get('snippet', '')
                 })
 
             return email_data
         except Exception as e:
-            print(f"Failed to fetch emails: {e}")
+            log.warning("Failed to fetch emails: %s", e)
             return []
\ No newline at end of file
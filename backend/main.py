@@ -1,18 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
+from pydantic import BaseModel, ConfigDict
 from dotenv import load_dotenv
 import os
+import asyncio
+import logging
 import sqlite3
+import threading
+import hashlib
+import time
+import jwt
 from datetime import datetime
-from auth import GmailAuth
+from auth import GmailAuth, TokenVerificationError
+from cachetools import TTLCache
 import httpx
-import json
+import orjson
 from typing import Optional, List, Dict, Any
 
 load_dotenv()
 
+logging.basicConfig(level=logging.INFO)
+# httpx logs every request at INFO (tokeninfo URLs include the access token);
+# keep it to warnings so the hot path doesn't gain a log line per request
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log = logging.getLogger("bytechat.api")
+
 app = FastAPI(title="ByteChat Google Auth API", version="1.0.0")
 
 # CORS middleware
@@ -24,6 +38,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Gzip responses, except on skip_paths such as the chat SSE stream: compressing it would
+# buffer tokens until the compressor flushes
+class PathSkippingGZipMiddleware(GZipMiddleware):
+    def __init__(self, app, minimum_size: int = 500, skip_paths: tuple = ()):
+        super().__init__(app, minimum_size=minimum_size)
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(PathSkippingGZipMiddleware, minimum_size=1024, skip_paths=("/api/chat/stream",))
+
 # Initialize Gmail Auth
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET")
@@ -35,6 +64,46 @@ gmail_auth = GmailAuth(
     client_secret=GOOGLE_CLIENT_SECRET
 )
 
+# Signed session tokens, issued at sign-in so later requests can skip Google verification
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+SESSION_TTL = int(os.getenv("SESSION_TTL", "900"))
+if not SESSION_SECRET:
+    raise ValueError("SESSION_SECRET not found in environment variables")
+
+def create_session(email: str) -> str:
+    """Mint a short-lived HS256 session token for a verified user"""
+    now = int(time.time())
+    return jwt.encode({"sub": email, "iat": now, "exp": now + SESSION_TTL}, SESSION_SECRET, algorithm="HS256")
+
+def session_email(authorization: Optional[str] = Header(None)) -> Optional[str]:
+    """Return the email from a valid `Authorization: Bearer <session>` header, else None"""
+    if not authorization:
+        return None
+
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+
+    try:
+        return jwt.decode(token, SESSION_SECRET, algorithms=["HS256"])["sub"]
+    except jwt.InvalidTokenError:
+        return None
+
+def current_user(email: Optional[str] = Depends(session_email)) -> str:
+    """Require a valid session and return its email"""
+    if not email:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return email
+
+# Signed-in users allowed to use admin endpoints such as /api/users
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
+
+def admin_user(email: str = Depends(current_user)) -> str:
+    """Require a valid session belonging to an address in ADMIN_EMAILS"""
+    if email.lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return email
+
 # OpenRouter Configuration
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4")
@@ -43,13 +112,97 @@ OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
 if not OPENROUTER_API_KEY:
     raise ValueError("OPENROUTER_API_KEY not found in environment variables")
 
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://bytechat.ai",
+    "X-Title": "ByteChat"
+}
+
+# Shared client so chat requests reuse pooled HTTP/2 connections to OpenRouter
+openrouter_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60.0,
+    limits=httpx.Limits(max_keepalive_connections=32)
+)
+
+# Email behind recently verified access tokens (keyed by SHA-256 of the token),
+# so repeat chat requests can look the user up in parallel with verification
+token_emails = TTLCache(maxsize=10_000, ttl=3600)
+
+# Server-sent event frames for /api/chat/stream
+def sse_event(data: dict) -> bytes:
+    """Frame a JSON payload as a server-sent event"""
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+def sse_error(message: str) -> bytes:
+    """Frame an error message as a server-sent event"""
+    return sse_event({"error": message})
+
+def token_update(tokens_left: int, tokens_used: int, session: Optional[str] = None) -> dict:
+    """Build the token_update event sent before [DONE], carrying a renewed session if any"""
+    update = {"type": "token_update", "tokens_left": tokens_left, "tokens_used": tokens_used}
+    if session:
+        update["session"] = session
+    return update
+
+async def terminated(chunks):
+    """Pass byte chunks through, closing the final event if upstream ended mid-line"""
+    last = b""
+    async for chunk in chunks:
+        if chunk:
+            last = chunk
+            yield chunk
+    if last and not last.endswith(b"\n"):
+        yield b"\n\n"
+
+SSE_DONE = b"data: [DONE]\n\n"
+SSE_TIMEOUT = sse_error("Request timeout")
+
+# Completed chat streams, replayed when the same user repeats an identical
+# request. Only temperature-0 requests are cached: sampled answers are expected
+# to differ when the user asks again
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", "3600"))
+chat_cache = TTLCache(maxsize=1000, ttl=CHAT_CACHE_TTL)
+
+def chat_cache_key(email: str, payload: dict) -> str:
+    """Hash the user and the full OpenRouter payload into a cache key"""
+    raw = orjson.dumps([email, payload], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+def with_prompt_caching(model: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Mark the system prompt as cacheable for providers that bill cached prefixes at a discount"""
+    if not model.startswith("anthropic/"):
+        return messages
+
+    for i, message in enumerate(messages):
+        if message["role"] != "system":
+            continue
+
+        content = message["content"]
+        if isinstance(content, str):
+            parts = [{"type": "text", "text": content}]
+        else:
+            parts = [dict(part) for part in content]
+        if not parts:
+            break
+
+        parts[-1]["cache_control"] = {"type": "ephemeral"}
+        return messages[:i] + [{**message, "content": parts}] + messages[i + 1:]
+
+    return messages
+
 # SQLite Database Setup
 DB_PATH = "users.db"
 
 def init_database():
-    """Initialize SQLite database with users table"""
-    conn = sqlite3.connect(DB_PATH)
+    """Open the shared SQLite connection and ensure the users table exists"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
     cursor = conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -63,69 +216,151 @@ def init_database():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
-    conn.close()
+    return conn
+
+def user_from_row(user) -> dict:
+    """Map a (id, email, name, picture, total_tokens, tokens_used, tokens_left) row to a dict"""
+    return {
+        "id": user[0],
+        "email": user[1],
+        "name": user[2],
+        "picture": user[3],
+        "total_tokens": user[4],
+        "tokens_used": user[5],
+        "tokens_left": user[6]
+    }
+
+def get_user(email: str):
+    """Get an existing user without modifying it"""
+    with db_lock:
+        user = db.execute('''
+            SELECT id, email, name, picture, total_tokens, tokens_used, tokens_left
+            FROM users
+            WHERE email = ?
+        ''', (email,)).fetchone()
+
+    return user_from_row(user) if user else None
 
 def get_or_create_user(email: str, name: str, picture: str = None):
     """Get existing user or create new one with default tokens"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    # Check if user exists
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-
-    if user:
-        # Update existing user info
-        cursor.execute('''
-            UPDATE users
-            SET name = ?, picture = ?, updated_at = ?
-            WHERE email = ?
-        ''', (name, picture, datetime.now(), email))
-        conn.commit()
-
-        # Get updated user
-        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-        user = cursor.fetchone()
-    else:
-        # Create new user with 1 million tokens
-        cursor.execute('''
-            INSERT INTO users (email, name, picture, total_tokens, tokens_used, tokens_left)
-            VALUES (?, ?, ?, 1000000, 0, 1000000)
-        ''', (email, name, picture))
-        conn.commit()
-
-        # Get created user
-        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-        user = cursor.fetchone()
-
-    conn.close()
-
-    if user:
-        return {
-            "id": user[0],
-            "email": user[1],
-            "name": user[2],
-            "picture": user[3],
-            "total_tokens": user[4],
-            "tokens_used": user[5],
-            "tokens_left": user[6]
-        }
-    return None
-
-# Initialize database on startup
-init_database()
+    # New users start with 1 million tokens (column defaults); existing users
+    # just get their profile refreshed
+    with db_lock:
+        user = db.execute('''
+            INSERT INTO users (email, name, picture)
+            VALUES (?, ?, ?)
+            ON CONFLICT(email) DO UPDATE SET
+                name = excluded.name,
+                picture = excluded.picture,
+                updated_at = ?
+            RETURNING id, email, name, picture, total_tokens, tokens_used, tokens_left
+        ''', (email, name, picture, datetime.now())).fetchone()
+
+    return user_from_row(user) if user else None
+
+# Single long-lived connection shared by all requests; writes are serialized
+# through db_lock
+db = init_database()
+db_lock = threading.Lock()
+
+# Token usage from finished chat streams, written to SQLite by token_writer
+token_queue: asyncio.Queue = asyncio.Queue()
+
+def record_token_usage(usage: List[tuple]):
+    """Apply (email, tokens) usage records in one transaction, one UPDATE per user"""
+    totals = {}
+    for email, tokens in usage:
+        totals[email] = totals.get(email, 0) + tokens
+
+    now = datetime.now()
+    with db_lock:
+        db.execute("BEGIN")
+        try:
+            db.executemany('''
+                UPDATE users
+                SET tokens_used = tokens_used + ?,
+                    tokens_left = tokens_left - ?,
+                    updated_at = ?
+                WHERE email = ?
+            ''', [(tokens, tokens, now, email) for email, tokens in totals.items()])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+async def token_writer():
+    """
+    Drain token_queue, coalescing usage that arrives within a short window; stops on None
+    Failed writes are retried with backoff so usage is never silently dropped
+    """
+    while True:
+        batch = [await token_queue.get()]
+        await asyncio.sleep(0.05)
+        while not token_queue.empty():
+            batch.append(token_queue.get_nowait())
+
+        usage = [item for item in batch if item is not None]
+        stopping = None in batch
+        attempt = 0
+        while usage:
+            try:
+                await asyncio.to_thread(record_token_usage, usage)
+                break
+            except Exception:
+                attempt += 1
+                log.exception("Failed to record token usage for %d entries (attempt %d)", len(usage), attempt)
+                if stopping and attempt >= 3:
+                    # Shutting down and the database won't take it: leave a record to reconcile from
+                    log.error("Dropping unrecorded token usage on shutdown: %s", usage)
+                    break
+
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 30))
+                # Fold in anything queued meanwhile so it's written in the same retry
+                while not token_queue.empty():
+                    item = token_queue.get_nowait()
+                    if item is None:
+                        stopping = True
+                    else:
+                        usage.append(item)
+
+        if stopping:
+            return
+
+@app.on_event("startup")
+async def startup():
+    app.state.token_writer = asyncio.create_task(token_writer())
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Flush pending token usage before closing the database
+    token_queue.put_nowait(None)
+    await app.state.token_writer
+    await openrouter_client.aclose()
+    await gmail_auth.aclose()
+    db.close()
+
+# Google being unreachable is not the user's fault: answer 503 rather than 401,
+# so clients keep their login and can retry
+@app.exception_handler(TokenVerificationError)
+async def token_verification_error_handler(request, exc: TokenVerificationError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
 
 # Pydantic models
 class TokenRequest(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
+
     access_token: str
 
 class Message(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
+
     role: str
     content: str | List[Dict[str, Any]]
 
 class ChatRequest(BaseModel):
-    access_token: str
+    model_config = ConfigDict(extra='forbid', frozen=True)
+
+    access_token: Optional[str] = None
     messages: List[Message]
     model: Optional[str] = None
     temperature: Optional[float] = 0.7
@@ -140,7 +375,7 @@ async def google_auth(request: TokenRequest):
     Called by frontend working code
     """
     try:
-        user_info = gmail_auth.verify_access_token(request.access_token)
+        user_info = await gmail_auth.verify_access_token(request.access_token)
 
         if not user_info:
             raise HTTPException(status_code=401, detail="Invalid access token")
@@ -155,36 +390,34 @@ async def google_auth(request: TokenRequest):
         if not user:
             raise HTTPException(status_code=500, detail="Failed to create user")
 
-        return user
+        return {**user, "session": create_session(user["email"])}
+    except TokenVerificationError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=401, detail=f"Google authentication failed: {str(e)}")
 
 # ENDPOINT 2: List all users (for debugging/admin)
-@app.get("/api/users")
-async def list_users():
+@app.get("/api/users", dependencies=[Depends(admin_user)])
+async def list_users(
+    limit: int = Query(1000, ge=1, le=10000),
+    offset: int = Query(0, ge=0)
+):
     """
-    List all users in the database with their token information
+    List users in the database with their token information, one page at a time
     """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users")
-        users = cursor.fetchall()
-        conn.close()
-
-        user_list = []
-        for user in users:
-            user_list.append({
-                "id": user[0],
-                "email": user[1],
-                "name": user[2],
-                "picture": user[3],
-                "total_tokens": user[4],
-                "tokens_used": user[5],
-                "tokens_left": user[6],
-                "created_at": user[7],
-                "updated_at": user[8]
-            })
+        with db_lock:
+            cursor = db.cursor()
+            cursor.row_factory = sqlite3.Row
+            users = cursor.execute('''
+                SELECT id, email, name, picture, total_tokens, tokens_used, tokens_left,
+                       created_at, updated_at
+                FROM users
+                ORDER BY id
+                LIMIT ? OFFSET ?
+            ''', (limit, offset)).fetchall()
+
+        user_list = [dict(user) for user in users]
 
         return {
             "success": True,
@@ -196,30 +429,57 @@ async def list_users():
 
 # ENDPOINT 3: Stream Chat Response with OpenRouter
 @app.post("/api/chat/stream")
-async def stream_chat(request: ChatRequest):
+async def stream_chat(request: ChatRequest, email: Optional[str] = Depends(session_email)):
     """
     Stream chat responses from OpenRouter API
-    - Verifies OAuth token
+    - Authenticates via session token, falling back to the OAuth token
     - Streams response from OpenRouter
     - Uses model and API key from .env
     """
     try:
-        # Verify access token
-        user_info = gmail_auth.verify_access_token(request.access_token)
-
-        if not user_info:
-            raise HTTPException(status_code=401, detail="Invalid access token")
-
-        # Get user from database
-        user = get_or_create_user(
-            email=user_info["email"],
-            name=user_info["name"],
-            picture=user_info.get("picture")
-        )
+        if email:
+            # Session already proves who this is; no Google round-trip needed
+            user = get_user(email)
+            if not user:
+                raise HTTPException(status_code=401, detail="Unknown user. Please sign in again.")
+            # Still valid, so no need to renew it
+            session = None
+        else:
+            if not request.access_token:
+                raise HTTPException(status_code=401, detail="Missing session or access token")
+
+            # For a token we've seen before, load the user while the token is verified
+            token_key = hashlib.sha256(request.access_token.encode()).hexdigest()
+            known_email = token_emails.get(token_key)
+            if known_email:
+                user_info, user = await asyncio.gather(
+                    gmail_auth.verify_access_token(request.access_token),
+                    asyncio.to_thread(get_user, known_email)
+                )
+            else:
+                user_info = await gmail_auth.verify_access_token(request.access_token)
+                user = None
+
+            if not user_info:
+                raise HTTPException(status_code=401, detail="Invalid access token")
+
+            # Get user from database unless the speculative lookup already found them
+            if not user or user["email"] != user_info["email"]:
+                user = get_or_create_user(
+                    email=user_info["email"],
+                    name=user_info["name"],
+                    picture=user_info.get("picture")
+                )
+            token_emails[token_key] = user_info["email"]
 
         if not user:
             raise HTTPException(status_code=500, detail="Failed to get user")
 
+        if email is None:
+            # Verified through Google: hand out a fresh session so the next
+            # request can skip Google again
+            session = create_session(user["email"])
+
         # Check if user has tokens left
         if user["tokens_left"] <= 0:
             raise HTTPException(
@@ -230,16 +490,8 @@ async def stream_chat(request: ChatRequest):
         # Use model from request or default from env
         model = request.model or OPENROUTER_MODEL
 
-        # Prepare OpenRouter request
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://bytechat.ai",
-            "X-Title": "ByteChat"
-        }
-
         # Convert messages to dict format
-        messages_dict = [msg.dict() for msg in request.messages]
+        messages_dict = request.model_dump(include={"messages"})["messages"]
 
         payload = {
             "model": model,
@@ -251,83 +503,105 @@ async def stream_chat(request: ChatRequest):
         if request.max_tokens:
             payload["max_tokens"] = request.max_tokens
 
+        cache_key = chat_cache_key(user["email"], payload) if request.temperature == 0 else None
+        cached_frames = chat_cache.get(cache_key) if cache_key else None
+        payload["messages"] = with_prompt_caching(model, messages_dict)
+        body = orjson.dumps(payload)
+
+        # Replay a cached completion; no upstream call, so no tokens are charged
+        async def replay():
+            for frame in cached_frames:
+                yield frame
+            yield sse_event(token_update(user["tokens_left"], 0, session))
+            yield SSE_DONE
+
         # Stream generator function
         async def generate():
             prompt_tokens = 0
             completion_tokens = 0
             total_tokens = 0
-
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                try:
-                    async with client.stream(
-                        "POST",
-                        OPENROUTER_BASE_URL,
-                        headers=headers,
-                        json=payload
-                    ) as response:
-                        if response.status_code != 200:
-                            error_text = await response.aread()
-                            yield f"data: {json.dumps({'error': f'OpenRouter API error: {error_text.decode()}'})}\n\n"
-                            return
-
-                        async for line in response.aiter_lines():
-                            if line.strip():
-                                if line.startswith("data: "):
-                                    data_str = line[6:]  # Remove "data: " prefix
-
-                                    if data_str.strip() == "[DONE]":
-                                        # Update user tokens in database after stream completes
-                                        updated_tokens_left = user["tokens_left"]
-                                        if total_tokens > 0:
-                                            conn = sqlite3.connect(DB_PATH)
-                                            cursor = conn.cursor()
-                                            cursor.execute('''
-                                                UPDATE users
-                                                SET tokens_used = tokens_used + ?,
-                                                    tokens_left = tokens_left - ?,
-                                                    updated_at = ?
-                                                WHERE email = ?
-                                            ''', (total_tokens, total_tokens, datetime.now(), user["email"]))
-                                            conn.commit()
-
-                                            # Get updated token count
-                                            cursor.execute("SELECT tokens_left FROM users WHERE email = ?", (user["email"],))
-                                            result = cursor.fetchone()
-                                            if result:
-                                                updated_tokens_left = result[0]
-
-                                            conn.close()
-
-                                            print(f"✅ Updated tokens for {user['email']}: used={total_tokens}, prompt={prompt_tokens}, completion={completion_tokens}, left={updated_tokens_left}")
-
-                                        # Send final message with updated token count
-                                        yield f"data: {json.dumps({'type': 'token_update', 'tokens_left': updated_tokens_left, 'tokens_used': total_tokens})}\n\n"
-                                        yield f"data: [DONE]\n\n"
-                                        break
-
-                                    try:
-                                        data = json.loads(data_str)
-
-                                        # Track token usage from OpenRouter response
-                                        # OpenRouter sends usage info in each chunk or final chunk
-                                        if "usage" in data:
-                                            usage = data["usage"]
-                                            prompt_tokens = usage.get("prompt_tokens", 0)
-                                            completion_tokens = usage.get("completion_tokens", 0)
-                                            total_tokens = usage.get("total_tokens", prompt_tokens + completion_tokens)
-
-                                        # Forward the chunk to frontend
-                                        yield f"data: {json.dumps(data)}\n\n"
-                                    except json.JSONDecodeError:
-                                        continue
-
-                except httpx.ReadTimeout:
-                    yield f"data: {json.dumps({'error': 'Request timeout'})}\n\n"
-                except Exception as e:
-                    yield f"data: {json.dumps({'error': f'Stream error: {str(e)}'})}\n\n"
+            # Frames relayed so far, cached once the stream completes
+            frames = []
+
+            try:
+                async with openrouter_client.stream(
+                    "POST",
+                    OPENROUTER_BASE_URL,
+                    headers=OPENROUTER_HEADERS,
+                    content=body
+                ) as response:
+                    if response.status_code != 200:
+                        error_text = await response.aread()
+                        yield sse_error(f"OpenRouter API error: {error_text.decode()}")
+                        return
+
+                    # Relay upstream bytes verbatim; only lines that may carry
+                    # usage info or the [DONE] marker are inspected
+                    buffer = b""
+                    async for chunk in terminated(response.aiter_bytes()):
+                        buffer += chunk
+                        cut = buffer.rfind(b"\n") + 1
+                        if not cut:
+                            continue
+                        complete, buffer = buffer[:cut], buffer[cut:]
+
+                        if b'"usage"' not in complete and b"[DONE]" not in complete:
+                            frames.append(complete)
+                            yield complete
+                            continue
+
+                        forward = []
+                        for line in complete.splitlines(keepends=True):
+                            stripped = line.strip()
+
+                            if stripped == b"data: [DONE]":
+                                if forward:
+                                    frames.append(b"".join(forward))
+                                    yield frames[-1]
+                                if cache_key:
+                                    chat_cache[cache_key] = frames
+
+                                # Queue the usage for the background writer and report the
+                                # expected balance without waiting on the database
+                                updated_tokens_left = user["tokens_left"] - total_tokens
+                                if total_tokens > 0:
+                                    token_queue.put_nowait((user["email"], total_tokens))
+
+                                    log.debug(
+                                        "Queued token usage for %s: used=%d, prompt=%d, completion=%d, left=%d",
+                                        user["email"], total_tokens, prompt_tokens, completion_tokens, updated_tokens_left
+                                    )
+
+                                # Send final message with updated token count
+                                yield sse_event(token_update(updated_tokens_left, total_tokens, session))
+                                yield SSE_DONE
+                                return
+
+                            # Track token usage from OpenRouter response
+                            # OpenRouter sends usage info in each chunk or final chunk
+                            if b'"usage"' in line and stripped.startswith(b"data: "):
+                                try:
+                                    usage = orjson.loads(stripped[6:]).get("usage")
+                                except orjson.JSONDecodeError:
+                                    usage = None
+
+                                if usage:
+                                    prompt_tokens = usage.get("prompt_tokens", 0)
+                                    completion_tokens = usage.get("completion_tokens", 0)
+                                    total_tokens = usage.get("total_tokens", prompt_tokens + completion_tokens)
+
+                            forward.append(line)
+
+                        frames.append(b"".join(forward))
+                        yield frames[-1]
+
+            except httpx.ReadTimeout:
+                yield SSE_TIMEOUT
+            except Exception as e:
+                yield sse_error(f"Stream error: {str(e)}")
 
         return StreamingResponse(
-            generate(),
+            replay() if cached_frames is not None else generate(),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -336,11 +610,44 @@ async def stream_chat(request: ChatRequest):
             }
         )
 
-    except HTTPException as he:
-        raise he
+    except (HTTPException, TokenVerificationError):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process chat request: {str(e)}")
 
+# ENDPOINT 4: Verify Token - ongoing verification of a signed-in user
+@app.post("/auth/verify-token")
+async def verify_token(request: TokenRequest):
+    """
+    Check that an access token is still valid and return the stored user
+    Read-only: only /api/auth/google creates or updates users
+    """
+    user_info = await gmail_auth.verify_access_token(request.access_token)
+
+    if not user_info:
+        raise HTTPException(status_code=401, detail="Invalid access token")
+
+    user = get_user(user_info["email"])
+
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found. Please sign in again.")
+
+    return {
+        "success": True,
+        "user": user
+    }
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Each worker is its own process with its own caches and SQLite connection
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        # "auto" picks uvloop/httptools when installed (uvicorn[standard] on
+        # Linux/macOS) and falls back to asyncio/h11 elsewhere, e.g. Windows
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WORKERS", "4")),
+        log_level="info"
+    )
\ No newline at end of file
@@ -98,7 +98,8 @@ class GoogleAuthService {
         total_tokens: userData.total_tokens,
         tokens_used: userData.tokens_used,
         tokens_left: userData.tokens_left,
-        access_token: token
+        access_token: token,
+        session: userData.session
       };
 
       const googleUser: GoogleUser = {
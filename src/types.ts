@@ -18,6 +18,7 @@ export interface User {
   tokens_used: number;
   tokens_left: number;
   access_token: string; // OAuth access token
+  session?: string; // Signed backend session token
 }
 
 // Multimodal content types for OpenRouter API
@@ -339,6 +339,8 @@ export async function callLLMStream(
       method: "POST",
       headers: {
         "Content-Type": "application/json",
+        // Session token lets the backend skip re-verifying the Google token
+        ...(user.session ? { Authorization: `Bearer ${user.session}` } : {}),
       },
       body: JSON.stringify({
         access_token: user.access_token,
@@ -415,6 +417,10 @@ export async function callLLMStream(
                 if (currentUser) {
                   currentUser.tokens_left = parsed.tokens_left;
                   currentUser.tokens_used += parsed.tokens_used;
+                  // Backend renews the session whenever it had to fall back to Google
+                  if (parsed.session) {
+                    currentUser.session = parsed.session;
+                  }
                   await setUser(currentUser);
                   console.log("✅ Updated user tokens in storage:", currentUser.tokens_left);
                 }